@@ -1,5 +1,34 @@
-from .gcp_bq_handler import GCPBigQueryHandler as GCPBigQueryHandler
-from .google_drive_handler import GoogleDriveHandler as GoogleDriveHandler
-from .replica_handler import ReplicaHandler as ReplicaHandler
-from .sftp_handler import SftpHandler as SftpHandler
-from .ftp_handler import FtpHandler as FtpHandler
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .gcp_bq_handler import GCPBigQueryHandler as GCPBigQueryHandler
+    from .google_drive_handler import GoogleDriveHandler as GoogleDriveHandler
+    from .replica_handler import ReplicaHandler as ReplicaHandler
+    from .sftp_handler import SftpHandler as SftpHandler
+    from .ftp_handler import FtpHandler as FtpHandler
+
+# The handlers are imported on first access, so importing a light module such
+# as lib_bi.email_sender does not load polars, pyarrow or the Google clients
+_HANDLER_MODULES = {
+    "GCPBigQueryHandler": ".gcp_bq_handler",
+    "GoogleDriveHandler": ".google_drive_handler",
+    "ReplicaHandler": ".replica_handler",
+    "SftpHandler": ".sftp_handler",
+    "FtpHandler": ".ftp_handler",
+}
+
+__all__ = list(_HANDLER_MODULES)
+
+
+def __getattr__(name: str):
+    module_name = _HANDLER_MODULES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    handler = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = handler
+    return handler
+
+
+def __dir__() -> list[str]:
+    return sorted([*globals(), *__all__])
@@ -1,69 +1,279 @@
+from __future__ import annotations
+
 import smtplib
 import os
+import time
+import queue
+import logging
 import base64
-from googleapiclient.discovery import build
+import tempfile
+from email.generator import BytesGenerator
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.errors import HttpError
-from google.auth.credentials import Credentials
-import pickle
+from email.mime.base import MIMEBase
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+# The Google client libraries are slow to import, they are imported where used
+# so SMTP only callers don't pay for them
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
 
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.send"]
+TOKEN_PATH = "token.json"
+# Bytes encoded per step when attaching a file, a multiple of the 57 bytes that
+# make a 76 character base64 line
+ATTACHMENT_READ_SIZE = 57 * 16 * 1024
 
-def send_email(
-    to_addrs: str | list[str],
+class SmtpSession:
+    """Keeps one authenticated SMTP_SSL connection open for many sends."""
+
+    def __init__(
+        self,
+        email_address: str,
+        email_password: str,
+        smtp_server: str = "",
+        smtp_port: int = 465,
+    ) -> None:
+        self.email_address = email_address
+        self.email_password = email_password
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.server: smtplib.SMTP_SSL | None = None
+        self.sent_count = 0
+
+    def __enter__(self) -> "SmtpSession":
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def connect(self) -> None:
+        self.server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port)
+        self.server.login(self.email_address, self.email_password)
+        self.sent_count = 0
+
+    def close(self) -> None:
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+        finally:
+            self.server = None
+
+    def reconnect(self) -> None:
+        self.close()
+        self.connect()
+
+    def send(
+        self,
+        to_addrs: str | list[str],
+        subject: str,
+        body_text: str,
+        files: str | list[str] | None = None,
+    ) -> None:
+        if not isinstance(to_addrs, list):
+            to_addrs = [to_addrs]
+
+        message = build_message(self.email_address, to_addrs, subject, body_text, files)
+
+        message_text = message.as_string()
+        if self.server is None:
+            self.connect()
+        # No NOOP before each message, a dropped connection is only found when
+        # sending, then the session reconnects and retries once
+        try:
+            self.server.sendmail(self.email_address, to_addrs, message_text)
+        except smtplib.SMTPServerDisconnected:
+            logging.info("SMTP connection lost, reconnecting")
+            self.reconnect()
+            self.server.sendmail(self.email_address, to_addrs, message_text)
+        self.sent_count += 1
+
+
+class SmtpPool:
+    """Spreads many sends over a fixed number of persistent SMTP sessions."""
+
+    TRANSIENT_CODES = {421, 450, 454, 554}
+
+    def __init__(
+        self,
+        email_address: str,
+        email_password: str,
+        smtp_server: str = "",
+        smtp_port: int = 465,
+        size: int = 5,
+        max_messages_per_connection: int = 100,
+        max_retries: int = 3,
+        backoff_seconds: float = 1.0,
+    ) -> None:
+        self.max_messages_per_connection = max_messages_per_connection
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.size = size
+        self.sessions: queue.Queue[SmtpSession] = queue.Queue()
+        for _ in range(size):
+            self.sessions.put(
+                SmtpSession(email_address, email_password, smtp_server, smtp_port)
+            )
+
+    def __enter__(self) -> "SmtpPool":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        while not self.sessions.empty():
+            self.sessions.get_nowait().close()
+
+    def _is_transient(self, error: Exception) -> bool:
+        if isinstance(error, smtplib.SMTPResponseException):
+            return error.smtp_code in self.TRANSIENT_CODES
+        if isinstance(error, smtplib.SMTPServerDisconnected):
+            return True
+        # SMTPException subclasses OSError; only plain socket errors are transient
+        return isinstance(error, OSError) and not isinstance(
+            error, smtplib.SMTPException
+        )
+
+    def send(
+        self,
+        to_addrs: str | list[str],
+        subject: str,
+        body_text: str,
+        files: str | list[str] | None = None,
+    ) -> None:
+        session = self.sessions.get()
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    if session.sent_count >= self.max_messages_per_connection:
+                        session.reconnect()
+                    session.send(to_addrs, subject, body_text, files)
+                    return
+                except Exception as error:
+                    if attempt == self.max_retries or not self._is_transient(error):
+                        logging.error(f"Couldn't send email to {to_addrs}: {error}")
+                        raise error
+                    logging.info(f"Transient SMTP error, retrying: {error}")
+                    time.sleep(self.backoff_seconds * 2**attempt)
+                    session.close()
+        finally:
+            self.sessions.put(session)
+
+    def send_many(self, messages: list[dict], max_workers: int | None = None) -> None:
+        """
+        Sends every message concurrently over the pooled connections.
+
+        Args:
+            messages (list[dict]): Keyword arguments for `send`, one dict per email
+                (to_addrs, subject, body_text and optionally files).
+            max_workers (int | None, optional): Number of sending threads. Defaults to the pool size.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers or self.size) as pool:
+            list(pool.map(lambda message: self.send(**message), messages))
+
+
+def file_attachment(file_path: str) -> MIMEBase:
+    """
+    Builds the attachment of a file, base64 encoding it while it is read in
+    chunks, so the whole raw file is never held in memory, only its encoded text.
+    """
+    attachment = MIMEBase(
+        "application", "octet-stream", Name=os.path.basename(file_path)
+    )
+    lines = []
+    with open(file_path, "rb") as file:
+        while chunk := file.read(ATTACHMENT_READ_SIZE):
+            lines.append(base64.encodebytes(chunk).decode("ascii"))
+    attachment.set_payload("".join(lines))
+    attachment["Content-Transfer-Encoding"] = "base64"
+    return attachment
+
+
+def build_message(
+    from_addr: str,
+    to_addrs: list[str],
     subject: str,
     body_text: str,
-    files: str | list[str],
-    email_address: str,
-    email_password: str,
-    smtp_server: str = "",
-    smtp_port: int = 465,
-) -> None:
-    if not isinstance(to_addrs, list):
-        to_addrs = [to_addrs]
-
-    if not isinstance(files, list):
+    files: str | list[str] | None = None,
+) -> MIMEMultipart:
+    if not files:
+        files = []
+    elif not isinstance(files, list):
         files = [files]
 
-    from_addr = email_address
-
     message = MIMEMultipart()
     message["Subject"] = subject
     message["From"] = from_addr
     message["To"] = ", ".join(to_addrs)
     message.attach(MIMEText(body_text))
 
-    with smtplib.SMTP_SSL(smtp_server, smtp_port) as server:
-        server.login(from_addr, email_password)
-        server.sendmail(from_addr, to_addrs, message.as_string())
+    for file_path in files:
+        message.attach(file_attachment(file_path))
+
+    return message
+
+
+def send_email(
+    to_addrs: str | list[str],
+    subject: str,
+    body_text: str,
+    files: str | list[str],
+    email_address: str,
+    email_password: str,
+    smtp_server: str = "",
+    smtp_port: int = 465,
+) -> None:
+    with SmtpSession(email_address, email_password, smtp_server, smtp_port) as session:
+        session.send(to_addrs, subject, body_text, files)
 
+@lru_cache(maxsize=4)
 def authorize(path_mail_json: str) -> Credentials:
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
     creds = None
-    if os.path.exists("token.pickle"):
-        with open("token.pickle", "rb") as token:
-            creds = pickle.load(token)
+    if os.path.exists(TOKEN_PATH):
+        creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         else:
             flow = InstalledAppFlow.from_client_secrets_file(path_mail_json, SCOPES)
             creds = flow.run_local_server(port=0)
-        with open("token.pickle", "wb") as token:
-            pickle.dump(creds, token)
+        with open(TOKEN_PATH, "w") as token:
+            token.write(creds.to_json())
     return creds
 
 
-def send_email_via_gmail(
-    to: str, subject: str, body_text: str, file_path: str, path_mail_json: str
-) -> None:
+GMAIL_BATCH_SIZE = 100
+
+
+@lru_cache(maxsize=4)
+def _gmail_service(path_mail_json: str):
+    from googleapiclient.discovery import build
+
     creds = authorize(path_mail_json)
-    service = build("gmail", "v1", credentials=creds)
+    return build(
+        "gmail",
+        "v1",
+        credentials=creds,
+        cache_discovery=False,
+        static_discovery=True,
+    )
+
 
+def build_gmail_message(
+    to: str, subject: str, body_text: str, file_path: str
+) -> MIMEMultipart | None:
     message = MIMEMultipart()
     message["to"] = to
     message["from"] = ""
@@ -76,17 +286,91 @@ def send_email_via_gmail(
         print(f"NO DATA: {to}")
         return None
 
-    with open(file_path, "rb") as file:
-        file_name = os.path.basename(file_path)
-        message.attach(MIMEApplication(file.read(), Name=file_name))
-
-    raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    body = {"raw": raw_message}
-
-    try:
-        message = service.users().messages().send(userId="me", body=body).execute()
-        print(f'Message Id: {message["id"]}')
-        return message
-    except HttpError as error:
-        print(f"An error occurred: {error}")
+    message.attach(file_attachment(file_path))
+
+    return message
+
+
+def build_gmail_raw_message(
+    to: str, subject: str, body_text: str, file_path: str
+) -> str | None:
+    message = build_gmail_message(to, subject, body_text, file_path)
+    if message is None:
+        return None
+
+    return base64.urlsafe_b64encode(message.as_bytes()).decode()
+
+
+def send_email_via_gmail(
+    to: str, subject: str, body_text: str, file_path: str, path_mail_json: str
+) -> None:
+    from googleapiclient.errors import HttpError
+    from googleapiclient.http import MediaIoBaseUpload
+
+    service = _gmail_service(path_mail_json)
+
+    message = build_gmail_message(to, subject, body_text, file_path)
+    if message is None:
         return None
+
+    # Serialize the message to disk and upload it as media in chunks, instead of
+    # keeping several base64 copies of the attachment in memory
+    with tempfile.TemporaryFile() as fh:
+        BytesGenerator(fh).flatten(message)
+        del message
+        fh.seek(0)
+        media = MediaIoBaseUpload(fh, mimetype="message/rfc822", resumable=True)
+
+        try:
+            message = (
+                service.users()
+                .messages()
+                .send(userId="me", body={}, media_body=media)
+                .execute()
+            )
+            print(f'Message Id: {message["id"]}')
+            return message
+        except HttpError as error:
+            print(f"An error occurred: {error}")
+            return None
+
+
+def send_emails_via_gmail_batch(messages: list[dict], path_mail_json: str) -> dict:
+    """
+    Sends many emails through the Gmail API packing up to 100 sends per HTTP request.
+    The messages of a batch are only built when the batch is sent.
+
+    Args:
+        messages (list[dict]): Keyword arguments for `build_gmail_raw_message`, one dict
+            per email (to, subject, body_text, file_path).
+        path_mail_json (str): Path to the OAuth client secrets file.
+
+    Returns:
+        dict: The sent message resources keyed by the index of their email in `messages`.
+            Emails without data or that failed are missing.
+    """
+    service = _gmail_service(path_mail_json)
+    sent = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            print(f"An error occurred: {exception}")
+            return
+        print(f'Message Id: {response["id"]}')
+        sent[int(request_id)] = response
+
+    for start in range(0, len(messages), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for index, message in enumerate(
+            messages[start : start + GMAIL_BATCH_SIZE], start
+        ):
+            raw = build_gmail_raw_message(**message)
+            if raw is None:
+                continue
+            batch.add(
+                service.users().messages().send(userId="me", body={"raw": raw}),
+                request_id=str(index),
+            )
+        batch.execute()
+
+    return sent
@@ -1,104 +1,283 @@
-import os
-import subprocess
-import time
-import logging
-import polars as pl
-
-
-def run_command(command: str, message_error: str) -> None:
-    result = subprocess.run(command, shell=True)
-    if not result.returncode == 0:
-        logging.error(message_error)
-        raise Exception
-
-
-def concat_parquet_to_csv_gzip(
-    part_tables_name: list, output_folder: str, conca_csv_name: str
-) -> None:
-    for table_name in part_tables_name:
-        start = time.time()
-        csv_file_path = [
-            f"{output_folder}/{csv_name}"
-            for csv_name in os.listdir(output_folder)
-            if ".csv.gz" not in csv_name
-            and ".csv" not in csv_name
-            and table_name in csv_name
-        ]
-
-        try:
-            lf = pl.scan_parquet(csv_file_path)
-
-            csv_name_path = os.path.join(
-                output_folder, conca_csv_name.format(table_name=table_name)
-            )
-
-            lf.sink_csv(csv_name_path)
-
-        except Exception as error:
-            logging.error(
-                f"Failed to concatenate csv for table {table_name}: {error}",
-                stack_info=True,
-            )
-            raise error
-
-        command_to_compress = f"gzip --fast {csv_name_path}"
-        run_command(command_to_compress, f"Failed to compress the csv: {csv_name_path}")
-
-        command_to_delete_parquet = f"rm -fr {output_folder}/*{table_name}*.parquet"
-        run_command(
-            command_to_delete_parquet,
-            f"Failed to delete all the csvs for the table: {table_name} ",
-        )
-
-        end = time.time()
-        execution_time = round((end - start) / 60, 2)
-        logging.info(
-            f"The csv {csv_name_path.replace(f'{output_folder}/', '')} was compressed.Time: {execution_time}"
-        )
-
-    logging.info("All the part tables were concatenated")
-
-
-def get_all_sql_files(path_sql: str, remove_file: str = "") -> dict:
-    """
-    Reads all SQL files in a directory and returns a dictionary with file names as keys and queries as values.
-    """
-    sqls_name = os.listdir(path_sql)
-    if remove_file:
-        sqls_name.remove(remove_file)
-    sql_dict = {}
-
-    for sql_file in sqls_name:
-        path = os.path.join(path_sql, sql_file)
-        with open(path, encoding="utf-8") as f:
-            sql = f.read()
-        sql_name = sql_file.replace(".sql", "")
-        sql_dict[sql_name] = sql
-
-    return sql_dict
-
-
-def get_sql_files(path_sql: str, sql_name_list: list) -> dict:
-    sql_dict = {}
-
-    for sql_file in sql_name_list:
-        path = os.path.join(path_sql, sql_file)
-        with open(path, encoding="utf-8") as f:
-            sql = f.read()
-        sql_name = sql_file.replace(".sql", "")
-        sql_dict[sql_name] = sql
-
-    return sql_dict
-
-
-def write_remove_empty_lines_in_txt(file_name: str) -> None:
-    # first get all lines from file
-    with open(file_name, "r") as f:
-        lines = f.readlines()
-
-    # remove spaces
-    lines = [line.replace(" ", "") for line in lines]
-
-    # finally, write lines in the file
-    with open(file_name, "w") as f:
-        f.writelines(lines)
+import os
+import re
+import glob
+import gzip
+import shlex
+import shutil
+import subprocess
+import time
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Iterator
+
+
+def run_command(command: list[str] | str, message_error: str) -> None:
+    """
+    Runs a command without a shell. String commands are split with shlex, so shell
+    features such as globs or pipes are not available.
+    """
+    if isinstance(command, str):
+        command = shlex.split(command)
+
+    result = subprocess.run(command, check=False, capture_output=True, text=True)
+    if not result.returncode == 0:
+        logging.error(f"{message_error}: {result.stderr}")
+        raise subprocess.CalledProcessError(
+            result.returncode, command, result.stdout, result.stderr
+        )
+
+
+@contextmanager
+def open_gzip_writer(
+    path: str, compresslevel: int = 1, threads: int | None = None
+) -> Iterator[IO[bytes]]:
+    """
+    Opens a binary writer that gzips into `path`. Uses `pigz` with `threads`
+    threads, all the cores by default, when it is installed and falls back to the
+    single-threaded `gzip` module otherwise.
+    """
+    pigz = shutil.which("pigz")
+    if pigz is None:
+        with gzip.open(path, "wb", compresslevel=compresslevel) as file:
+            yield file
+        return
+
+    with open(path, "wb") as output:
+        process = subprocess.Popen(
+            [pigz, f"-{compresslevel}", "-p", str(threads or os.cpu_count() or 1)],
+            stdin=subprocess.PIPE,
+            stdout=output,
+        )
+        try:
+            yield process.stdin
+        finally:
+            process.stdin.close()
+            returncode = process.wait()
+    if returncode != 0:
+        raise Exception(f"pigz failed compressing {path}")
+
+
+def write_parquet_parts_to_csv_gzip(
+    parquet_paths: list,
+    csv_gzip_path: str,
+    compresslevel: int = 1,
+    threads: int | None = None,
+) -> None:
+    """
+    Streams parquet parts into a single gzip compressed csv without writing the
+    uncompressed csv to disk. Only one record batch is held in memory at a time.
+    """
+    import polars as pl
+    import pyarrow.dataset as ds
+
+    # The dataset scanner reads the metadata and row groups of the next parts in
+    # background threads while the current batches are written
+    dataset = ds.dataset(parquet_paths, format="parquet")
+    with open_gzip_writer(csv_gzip_path, compresslevel, threads) as file:
+        pl.from_arrow(dataset.schema.empty_table()).write_csv(file)
+        for batch in dataset.to_batches(
+            use_threads=True, fragment_readahead=4, batch_readahead=16
+        ):
+            pl.from_arrow(batch).write_csv(file, include_header=False)
+
+
+def _table_part_paths(part_tables_name: list, output_folder: str) -> dict:
+    """
+    Maps every table to the sorted paths of its parts. The table name must be
+    followed by '_', '-' or '.', and a part matching several tables goes to the
+    longest name, so 'orders' does not take the parts of 'orders_items'.
+    """
+    patterns = sorted(
+        (
+            (table_name, re.compile(rf"{re.escape(table_name)}[_.-]"))
+            for table_name in part_tables_name
+        ),
+        key=lambda item: len(item[0]),
+        reverse=True,
+    )
+    part_paths = {table_name: [] for table_name in part_tables_name}
+    for entry in os.scandir(output_folder):
+        if ".csv" in entry.name or not entry.is_file():
+            continue
+        for table_name, pattern in patterns:
+            if pattern.search(entry.name):
+                part_paths[table_name].append(entry.path)
+                break
+
+    return {table_name: sorted(paths) for table_name, paths in part_paths.items()}
+
+
+def _concat_table_to_csv_gzip(
+    table_name: str,
+    part_paths: list,
+    output_folder: str,
+    conca_csv_name: str,
+    threads: int,
+) -> None:
+    start = time.time()
+
+    csv_name_path = os.path.join(
+        output_folder, conca_csv_name.format(table_name=table_name)
+    )
+
+    try:
+        write_parquet_parts_to_csv_gzip(
+            part_paths, f"{csv_name_path}.gz", threads=threads
+        )
+
+    except Exception as error:
+        logging.error(
+            f"Failed to concatenate csv for table {table_name}: {error}",
+            stack_info=True,
+        )
+        raise error
+
+    try:
+        # Only the parts read above, other tables may still be reading theirs
+        for part_path in part_paths:
+            os.remove(part_path)
+    except OSError as error:
+        logging.error(
+            f"Failed to delete all the parquets for the table: {table_name}: {error}"
+        )
+        raise error
+
+    end = time.time()
+    execution_time = round((end - start) / 60, 2)
+    logging.info(
+        f"The csv {csv_name_path.replace(f'{output_folder}/', '')} was compressed.Time: {execution_time}"
+    )
+
+
+def concat_parquet_to_csv_gzip(
+    part_tables_name: list,
+    output_folder: str,
+    conca_csv_name: str,
+    max_workers: int | None = None,
+) -> None:
+    max_workers = max_workers or max(
+        1, min(len(part_tables_name), os.cpu_count() or 1)
+    )
+    # The cores are split between the tables compressed at once, instead of each
+    # pigz starting a thread per core
+    threads = max(1, (os.cpu_count() or 1) // max_workers)
+    # The parts are listed before any table starts, so each thread only reads and
+    # deletes its own
+    part_paths = _table_part_paths(part_tables_name, output_folder)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(
+            pool.map(
+                lambda table_name: _concat_table_to_csv_gzip(
+                    table_name,
+                    part_paths[table_name],
+                    output_folder,
+                    conca_csv_name,
+                    threads,
+                ),
+                part_tables_name,
+            )
+        )
+
+    logging.info("All the part tables were concatenated")
+
+
+def concat_parquet_parts(
+    part_tables_name: list, output_folder: str, out_name: str
+) -> None:
+    """
+    Concatenates the parquet parts of every table into a single zstd compressed
+    parquet, skipping the csv conversion. Use it when the consumer reads parquet.
+    """
+    import polars as pl
+
+    for table_name in part_tables_name:
+        start = time.time()
+        out_path = os.path.join(output_folder, out_name.format(table_name=table_name))
+        # glob returns the parts in directory order, sort them to keep the rows in order
+        parquet_file_path = [
+            path
+            for path in sorted(glob.glob(f"{output_folder}/*{table_name}*.parquet"))
+            if path != out_path
+        ]
+
+        try:
+            pl.scan_parquet(
+                parquet_file_path,
+                parallel="row_groups",
+                low_memory=False,
+                rechunk=False,
+                cache=False,
+            ).sink_parquet(
+                out_path,
+                compression="zstd",
+                compression_level=3,
+                row_group_size=1_000_000,
+            )
+
+        except Exception as error:
+            logging.error(
+                f"Failed to concatenate parquet for table {table_name}: {error}",
+                stack_info=True,
+            )
+            raise error
+
+        try:
+            for parquet_path in parquet_file_path:
+                os.remove(parquet_path)
+        except OSError as error:
+            logging.error(
+                f"Failed to delete all the parquets for the table: {table_name}: {error}"
+            )
+            raise error
+
+        end = time.time()
+        execution_time = round((end - start) / 60, 2)
+        logging.info(
+            f"The parquet {out_path.replace(f'{output_folder}/', '')} was concatenated.Time: {execution_time}"
+        )
+
+    logging.info("All the part tables were concatenated")
+
+
+def _read_file(path: str) -> str:
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def _read_sql_files(path_sql: str, sqls_name: list, max_workers: int = 16) -> dict:
+    paths = [os.path.join(path_sql, sql_file) for sql_file in sqls_name]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        sqls = list(pool.map(_read_file, paths))
+
+    return {
+        sql_file.replace(".sql", ""): sql for sql_file, sql in zip(sqls_name, sqls)
+    }
+
+
+def get_all_sql_files(path_sql: str, remove_file: str = "") -> dict:
+    """
+    Reads all SQL files in a directory and returns a dictionary with file names as keys and queries as values.
+    """
+    sqls_name = [
+        entry.name
+        for entry in os.scandir(path_sql)
+        if not remove_file or entry.name != remove_file
+    ]
+
+    return _read_sql_files(path_sql, sqls_name)
+
+
+def get_sql_files(path_sql: str, sql_name_list: list) -> dict:
+    return _read_sql_files(path_sql, sql_name_list)
+
+
+def write_remove_empty_lines_in_txt(file_name: str) -> None:
+    # remove all the spaces streaming the file in 1MB chunks
+    tmp_file_name = f"{file_name}.tmp"
+    with open(file_name, "rb") as fin, open(tmp_file_name, "wb") as fout:
+        while chunk := fin.read(1 << 20):
+            fout.write(chunk.translate(None, b" "))
+
+    # finally, replace the original file
+    os.replace(tmp_file_name, file_name)
@@ -1,14 +1,83 @@
 import os
 import ftplib
 import logging
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
 
+UPLOAD_BLOCKSIZE = 1 << 20
+
 
 class FtpHandler:
     def __init__(self, host: str, username: str, password: str):
-        self.conn = ftplib.FTP(host)
-        self.conn.login(user=username, passwd=password)
+        self.host = host
+        self.username = username
+        self.password = password
+        # ftplib.FTP is not thread-safe, each thread gets its own connection
+        self._local = threading.local()
+        # Open connection of every thread, to close them when the thread is gone
+        self._conns: dict[threading.Thread, ftplib.FTP] = {}
+        self._conns_lock = threading.Lock()
+        self._pool: ThreadPoolExecutor | None = None
+        self._pool_size = 0
+        # Log in once to fail fast on bad credentials, the uploads run on the
+        # pool threads with their own connections
+        self._quit(self._open_connection())
+
+    @property
+    def conn(self) -> ftplib.FTP:
+        return self._connect()
+
+    def _open_connection(self) -> ftplib.FTP:
+        conn = ftplib.FTP(self.host)
+        conn.login(user=self.username, passwd=self.password)
+        return conn
+
+    @staticmethod
+    def _quit(conn: ftplib.FTP) -> None:
+        try:
+            conn.quit()
+        except (ftplib.Error, OSError):
+            conn.close()
+
+    def _connect(self) -> ftplib.FTP:
+        """Returns the connection of the calling thread, opening it if needed."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open_connection()
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns[threading.current_thread()] = conn
+        return conn
+
+    def _close_dead_threads_connections(self) -> None:
+        with self._conns_lock:
+            dead_threads = [thread for thread in self._conns if not thread.is_alive()]
+            conns = [self._conns.pop(thread) for thread in dead_threads]
+        for conn in conns:
+            self._quit(conn)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        with self._conns_lock:
+            conns = list(self._conns.values())
+            self._conns.clear()
+        for conn in conns:
+            self._quit(conn)
+        self._local = threading.local()
+
+    def _get_pool(self, max_workers: int) -> ThreadPoolExecutor:
+        if self._pool is None or self._pool_size != max_workers:
+            if self._pool is not None:
+                # shutdown waits for the workers to exit, then their connections
+                # are closed instead of staying open until close()
+                self._pool.shutdown()
+                self._close_dead_threads_connections()
+            self._pool = ThreadPoolExecutor(max_workers=max_workers)
+            self._pool_size = max_workers
+        return self._pool
 
     def upload_files(self, output_folder: str, filename: str) -> None:
         local_file_path = os.path.join(output_folder, filename)
@@ -16,20 +85,24 @@ class FtpHandler:
         if os.path.isfile(local_file_path):
             try:
                 with open(local_file_path, "rb") as file:
-                    self.conn.storbinary(f"STOR {filename}", file)
+                    self.conn.storbinary(
+                        f"STOR {filename}", file, blocksize=UPLOAD_BLOCKSIZE
+                    )
                 logging.info(f"Uploaded: {filename}")
             except Exception as error:
                 logging.info(f"Couldn't upload: {filename}")
                 raise error
 
-    def upload_all_files_in_parallel(self, output_folder: str):
+    def upload_all_files_in_parallel(self, output_folder: str, max_workers: int = 8):
         start = time.time()
         files_name_to_upload = os.listdir(output_folder)
-        with ThreadPoolExecutor() as pool:
+        pool = self._get_pool(max_workers)
+        list(
             pool.map(
                 lambda item: self.upload_files(output_folder, item),
                 files_name_to_upload,
             )
+        )
 
         logging.info("All files loaded successfully :3")
         end = time.time()
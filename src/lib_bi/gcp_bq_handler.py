@@ -1,270 +1,467 @@
-import io
-import re
-import json
-import logging
-import polars as pl
-from datetime import datetime
-from google.cloud import bigquery
-from google.auth.credentials import Credentials
-from google.cloud.bigquery.table import RowIterator
-from google.cloud.bigquery.job.base import _AsyncJob
-from concurrent.futures import ThreadPoolExecutor
-
-
-class GCPBigQueryHandler:
-    def __init__(
-        self, project: str | None = None, credentials: Credentials | None = None
-    ) -> None:
-        self.client = bigquery.Client(project=project, credentials=credentials)
-
-    def execute_query(
-        self,
-        sql: str,
-        timeout: int = 30,
-        job_config: bigquery.QueryJobConfig | None = None,
-        page_size: int | None = None,
-    ) -> RowIterator:
-        try:
-            query_job = self.client.query(sql, job_config=job_config)
-            return query_job.result(timeout=timeout, page_size=page_size)
-        except Exception as error:
-            logging.error(
-                f"Executing query: {sql}\n The error is: {error}", stack_info=True
-            )
-            raise error
-
-    def execute_query_to_df(
-        self,
-        sql: str,
-        timeout: int = 30,
-        job_config: bigquery.QueryJobConfig | None = None,
-    ):
-        try:
-            result = self.execute_query(sql, timeout, job_config)
-            return result.to_dataframe()
-        except Exception as error:
-            logging.error(
-                f"Failed converting query result to pandas dataframe: {sql}\n The error is: {error}",
-                stack_info=True,
-            )
-            raise error
-
-    def execute_query_log_errs(
-        self,
-        sql: str,
-        dict_to_insert: dict,
-        column_log_name: str,
-        column_datetime_name: str,
-        dataset_id: str,
-        table_id: str,
-        timeout: int = 30,
-        job_config: bigquery.QueryJobConfig | None = None,
-        page_size: int | None = None,) -> RowIterator:
-        """
-        Executes a SQL query and logs any errors that occur during execution to a BigQuery table.
-
-        Args:
-            sql (str): The SQL query string to be executed.
-            extra_columns_to_insert (dict): Additional column values to insert into the error log table.
-            column_error_name (str): Name of the column where the error message will be stored.
-            column_datetime_name (str): Name of the column where the timestamp of the error occurrence will be stored.
-            dataset_id (str): ID of the BigQuery dataset where the error log table resides.
-            table_id (str): ID of the BigQuery table where errors should be logged.
-            timeout (int, optional): Maximum execution time for the query in seconds. Defaults to 30.
-            job_config (bigquery.QueryJobConfig | None, optional): Configuration object for the query execution. Defaults to None.
-            page_size (int | None, optional): Pagination size for query results, if applicable. Defaults to None.
-
-        Raises:
-            Exception: Any error encountered during query execution is logged and then re-raised.
-
-        Ejemplo:
-            >>> extra_columns = {
-            ...     "user_id": 123,
-            ...     "operation": "data_update"
-            ... }
-            >>> execute_query_log_errs(
-            ...     sql="SELECT * FROM my_table",
-            ...     extra_columns_to_insert=extra_columns,
-            ...     column_error_name="error_message",
-            ...     column_datetime_name="error_timestamp",
-            ...     dataset_id="my_dataset",
-            ...     table_id="error_log"
-            ... )
-        """
-
-        try:
-            result = self.execute_query(sql, timeout, job_config, page_size)
-           
-            return result
-        except Exception as error:
-            current_time = datetime.now()
-            dict_to_insert[column_log_name] = error
-            dict_to_insert[column_datetime_name] = current_time
-            table_ref = self.client.dataset(dataset_id).table(table_id)
-            json_to_insert = json.loads(json.dumps(dict_to_insert, default=str))
-            self.client.insert_rows_json(table_ref, [json_to_insert])
-
-            raise error
-
-    def export_table_to_storage(
-        self,
-        project: str,
-        dataset_id: str,
-        table_id: str,
-        gcs_path: str,
-        location="southamerica-west1",
-        format_table=bigquery.DestinationFormat.CSV,
-        compression=bigquery.Compression.GZIP,
-    ) -> _AsyncJob:
-        """
-        Exports a BigQuery table to a specified Cloud Storage destination.
-
-        Args:
-            project (str): GCP project ID.
-            dataset_id (str): BigQuery dataset ID.
-            table_id (str): BigQuery table ID.
-            gcs_path (str): Cloud Storage destination URI (e.g., 'gs://my-bucket/my-file').
-            location (str, optional): Location of the BigQuery table. Defaults to 'southamerica-west1'.
-            compression (str, optional): Compression type for the exported file. Defaults to GZIP.
-
-        Returns:
-            ExtractJob.result: The result of the extract job.
-        """
-        dataset_ref = bigquery.DatasetReference(project, dataset_id)
-        table_ref = dataset_ref.table(table_id)
-        try:
-            # Job configuration
-            job_config = bigquery.ExtractJobConfig()
-            job_config.destination_format = format_table
-            job_config.compression = compression
-
-            # API request to export table
-            extract_job = self.client.extract_table(
-                table_ref,
-                gcs_path,
-                location=location,
-                job_config=job_config,
-                timeout=10000,
-            )
-
-            # Wait for job completion
-            result = extract_job.result()
-
-            return result
-
-        except Exception as error:
-            logging.error(
-                f"Failed to export table {table_ref} to {gcs_path}: {error}",
-                stack_info=True,
-            )
-            raise error
-
-    def load_df_to_table(self, path_table_name: str, df: pl.DataFrame):
-        # Write DataFrame to stream as parquet file; does not hit disk
-        with io.BytesIO() as stream:
-            df.write_parquet(stream)
-            stream.seek(0)
-            job = self.client.load_table_from_file(
-                stream,
-                destination=path_table_name,
-                project="mi-casino",
-                job_config=bigquery.LoadJobConfig(
-                    source_format=bigquery.SourceFormat.PARQUET,
-                ),
-            )
-        try:
-            job.result()
-        except Exception as error:
-            logging.error(f"Could not load the df to {path_table_name}: {error}")
-            raise error
-
-    def execute_query_to_df_polars(
-        self,
-        sql: str,
-        timeout: int = 30,
-        job_config: bigquery.QueryJobConfig | None = None,
-    ) -> pl.DataFrame | None:
-        try:
-            results = self.execute_query(
-                sql,
-                timeout,
-                job_config,
-            ).to_dataframe()
-
-            df = pl.from_pandas(results)
-
-            return df
-        except Exception as error:
-            logging.error(
-                f"Failed converting query result to polars dataframe: {sql}\n The error is: {error}",
-                stack_info=True,
-            )
-            raise error
-
-    def get_tables_name_with_regex(self, proyect_id, dataset_id, regex: re.Pattern):
-        """
-        Retrieves the full paths of tables in a BigQuery dataset that start with 'get_'.
-
-        Args:
-            proyecto_id (str): The ID of the Google Cloud project.
-            dataset_id (str): The ID of the BigQuery dataset.
-
-        Returns:
-            list: A list of full paths for tables that start with 'get_'.
-        """
-
-        # Get the dataset reference
-        dataset_ref = self.client.dataset(dataset_id, proyect_id)
-        tables = self.client.list_tables(dataset_ref)
-
-        # Filter tables that start with 'get_'
-        get_tables = [
-            table.table_id for table in tables if re.match(regex, table.table_id)
-        ]
-
-        # Get full paths
-        table_names = [table for table in get_tables]
-
-        return table_names
-
-    def load_to_gcs_in_parallel(
-        self,
-        tables_name: str,
-        uri_path: str,
-        proyect_id: str,
-        dataset_id: str,
-    ) -> None:
-        with ThreadPoolExecutor() as pool:
-            pool.map(
-                lambda table_name: self.export_table_to_storage(
-                    proyect_id,
-                    dataset_id,
-                    table_name,
-                    uri_path.format(table_name=table_name),
-                ),
-                tables_name,
-            )
-
-    def check_and_create_table(
-        self,
-        dataset_id: str,
-        table_id: str,
-        schema: list[bigquery.SchemaField],
-        rows_to_insert: dict,
-    ) -> None:
-        table_ref = self.client.dataset(dataset_id).table(table_id)
-
-        try:
-            self.client.get_table(table_ref)
-        except Exception:
-            table = bigquery.Table(table_ref, schema=schema)
-            table = self.client.create_table(table)
-            logging.info(f"The table {table_ref} was created")
-
-        try:
-            self.client.insert_rows_json(table_ref, [rows_to_insert])
-        except Exception as error:
-            logging.error(
-                f"There were errors inserting the data into the table {table_ref}. {error}"
-            )
-            raise error
+import io
+import re
+import json
+import logging
+import polars as pl
+import pyarrow as pa
+from datetime import datetime
+from typing import Iterator
+from google.cloud import bigquery
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types
+from google.api_core.exceptions import NotFound
+from google.auth.credentials import Credentials
+from google.cloud.bigquery.table import RowIterator
+from google.cloud.bigquery.job.base import _AsyncJob
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Frames above this size are loaded with a parquet load job instead of the Storage Write API
+STORAGE_WRITE_MAX_BYTES = 100 * 1024 * 1024
+# AppendRows requests are limited to 10MB, keep some margin
+APPEND_ROWS_MAX_BYTES = 8 * 1024 * 1024
+
+
+class GCPBigQueryHandler:
+    def __init__(
+        self, project: str | None = None, credentials: Credentials | None = None
+    ) -> None:
+        self.credentials = credentials
+        self.client = bigquery.Client(project=project, credentials=credentials)
+        self._write_client: bigquery_storage_v1.BigQueryWriteClient | None = None
+        self._read_client: bigquery_storage_v1.BigQueryReadClient | None = None
+        self._pool: ThreadPoolExecutor | None = None
+        self._pool_size = 0
+        self._known_tables: set[str] = set()
+        self._table_refs: dict[str, bigquery.TableReference] = {}
+        self._regexes: dict[str, re.Pattern] = {}
+
+    def _get_pool(self, max_workers: int) -> ThreadPoolExecutor:
+        if self._pool is None or self._pool_size != max_workers:
+            if self._pool is not None:
+                self._pool.shutdown()
+            self._pool = ThreadPoolExecutor(max_workers=max_workers)
+            self._pool_size = max_workers
+        return self._pool
+
+    def _compile_regex(self, pattern: str) -> re.Pattern:
+        regex = self._regexes.get(pattern)
+        if regex is None:
+            regex = re.compile(pattern)
+            self._regexes[pattern] = regex
+        return regex
+
+    @property
+    def read_client(self) -> bigquery_storage_v1.BigQueryReadClient:
+        if self._read_client is None:
+            self._read_client = bigquery_storage_v1.BigQueryReadClient(
+                credentials=self.credentials
+            )
+        return self._read_client
+
+    @property
+    def write_client(self) -> bigquery_storage_v1.BigQueryWriteClient:
+        if self._write_client is None:
+            self._write_client = bigquery_storage_v1.BigQueryWriteClient(
+                credentials=self.credentials
+            )
+        return self._write_client
+
+    def execute_query(
+        self,
+        sql: str,
+        timeout: int = 30,
+        job_config: bigquery.QueryJobConfig | None = None,
+        page_size: int | None = None,
+    ) -> RowIterator:
+        try:
+            query_job = self.client.query(sql, job_config=job_config)
+            return query_job.result(timeout=timeout, page_size=page_size)
+        except Exception as error:
+            logging.error(
+                f"Executing query: {sql}\n The error is: {error}", stack_info=True
+            )
+            raise error
+
+    def execute_query_to_df(
+        self,
+        sql: str,
+        timeout: int = 30,
+        job_config: bigquery.QueryJobConfig | None = None,
+    ):
+        try:
+            result = self.execute_query(sql, timeout, job_config)
+            return result.to_dataframe()
+        except Exception as error:
+            logging.error(
+                f"Failed converting query result to pandas dataframe: {sql}\n The error is: {error}",
+                stack_info=True,
+            )
+            raise error
+
+    def execute_query_to_arrow_batches(
+        self,
+        sql: str,
+        timeout: int = 30,
+        job_config: bigquery.QueryJobConfig | None = None,
+        max_queue_size: int = 4,
+    ) -> Iterator[pa.RecordBatch]:
+        """
+        Executes a SQL query and yields the result as Arrow record batches, read
+        through the BigQuery Storage Read API, so only a few batches are held in memory.
+
+        Args:
+            sql (str): The SQL query string to be executed.
+            timeout (int, optional): Maximum execution time for the query in seconds. Defaults to 30.
+            job_config (bigquery.QueryJobConfig | None, optional): Configuration object for the query execution. Defaults to None.
+            max_queue_size (int, optional): Maximum number of batches buffered ahead of the consumer. Defaults to 4.
+
+        Yields:
+            pa.RecordBatch: The next batch of rows. Use `pa.Table.from_batches` to build a full table.
+        """
+        result = self.execute_query(sql, timeout, job_config)
+        try:
+            yield from result.to_arrow_iterable(
+                bqstorage_client=self.read_client, max_queue_size=max_queue_size
+            )
+        except Exception as error:
+            logging.error(
+                f"Failed streaming query result as arrow batches: {sql}\n The error is: {error}",
+                stack_info=True,
+            )
+            raise error
+
+    def execute_query_log_errs(
+        self,
+        sql: str,
+        dict_to_insert: dict,
+        column_log_name: str,
+        column_datetime_name: str,
+        dataset_id: str,
+        table_id: str,
+        timeout: int = 30,
+        job_config: bigquery.QueryJobConfig | None = None,
+        page_size: int | None = None,) -> RowIterator:
+        """
+        Executes a SQL query and logs any errors that occur during execution to a BigQuery table.
+
+        Args:
+            sql (str): The SQL query string to be executed.
+            extra_columns_to_insert (dict): Additional column values to insert into the error log table.
+            column_error_name (str): Name of the column where the error message will be stored.
+            column_datetime_name (str): Name of the column where the timestamp of the error occurrence will be stored.
+            dataset_id (str): ID of the BigQuery dataset where the error log table resides.
+            table_id (str): ID of the BigQuery table where errors should be logged.
+            timeout (int, optional): Maximum execution time for the query in seconds. Defaults to 30.
+            job_config (bigquery.QueryJobConfig | None, optional): Configuration object for the query execution. Defaults to None.
+            page_size (int | None, optional): Pagination size for query results, if applicable. Defaults to None.
+
+        Raises:
+            Exception: Any error encountered during query execution is logged and then re-raised.
+
+        Ejemplo:
+            >>> extra_columns = {
+            ...     "user_id": 123,
+            ...     "operation": "data_update"
+            ... }
+            >>> execute_query_log_errs(
+            ...     sql="SELECT * FROM my_table",
+            ...     extra_columns_to_insert=extra_columns,
+            ...     column_error_name="error_message",
+            ...     column_datetime_name="error_timestamp",
+            ...     dataset_id="my_dataset",
+            ...     table_id="error_log"
+            ... )
+        """
+
+        try:
+            result = self.execute_query(sql, timeout, job_config, page_size)
+           
+            return result
+        except Exception as error:
+            current_time = datetime.now()
+            dict_to_insert[column_log_name] = error
+            dict_to_insert[column_datetime_name] = current_time
+            table_ref = self.client.dataset(dataset_id).table(table_id)
+            json_to_insert = json.loads(json.dumps(dict_to_insert, default=str))
+            self.client.insert_rows_json(table_ref, [json_to_insert])
+
+            raise error
+
+    def export_table_to_storage(
+        self,
+        project: str,
+        dataset_id: str,
+        table_id: str,
+        gcs_path: str,
+        location="southamerica-west1",
+        format_table=bigquery.DestinationFormat.CSV,
+        compression=bigquery.Compression.GZIP,
+    ) -> _AsyncJob:
+        """
+        Exports a BigQuery table to a specified Cloud Storage destination.
+
+        Args:
+            project (str): GCP project ID.
+            dataset_id (str): BigQuery dataset ID.
+            table_id (str): BigQuery table ID.
+            gcs_path (str): Cloud Storage destination URI (e.g., 'gs://my-bucket/my-file').
+            location (str, optional): Location of the BigQuery table. Defaults to 'southamerica-west1'.
+            compression (str, optional): Compression type for the exported file. Defaults to GZIP.
+
+        Returns:
+            ExtractJob.result: The result of the extract job.
+        """
+        dataset_ref = bigquery.DatasetReference(project, dataset_id)
+        table_ref = dataset_ref.table(table_id)
+        try:
+            # Job configuration
+            job_config = bigquery.ExtractJobConfig()
+            job_config.destination_format = format_table
+            job_config.compression = compression
+
+            # API request to export table
+            extract_job = self.client.extract_table(
+                table_ref,
+                gcs_path,
+                location=location,
+                job_config=job_config,
+                timeout=10000,
+            )
+
+            # Wait for job completion
+            result = extract_job.result()
+
+            return result
+
+        except Exception as error:
+            logging.error(
+                f"Failed to export table {table_ref} to {gcs_path}: {error}",
+                stack_info=True,
+            )
+            raise error
+
+    @staticmethod
+    def _serialize_batches(batches: list[pa.RecordBatch]) -> Iterator[bytes]:
+        # The batches are sized from the average row size, halve any batch whose
+        # serialized size is still over the AppendRows limit
+        for batch in batches:
+            serialized = batch.serialize()
+            if serialized.size > APPEND_ROWS_MAX_BYTES and batch.num_rows > 1:
+                half = batch.num_rows // 2
+                yield from GCPBigQueryHandler._serialize_batches(
+                    [batch.slice(0, half), batch.slice(half)]
+                )
+            else:
+                yield serialized.to_pybytes()
+
+    def append_df_with_write_api(self, path_table_name: str, df: pl.DataFrame) -> None:
+        """
+        Appends a DataFrame to an existing table streaming Arrow record batches
+        to a pending stream of the BigQuery Storage Write API. The rows only
+        become visible when the stream is committed after the last batch, so
+        like a load job the append is all-or-nothing and safe to retry.
+
+        Args:
+            path_table_name (str): Destination as 'project.dataset.table' or 'dataset.table',
+                resolved against the client's project.
+            df (pl.DataFrame): Rows to append.
+        """
+        table_path = path_table_name.split(".")
+        if len(table_path) == 2:
+            table_path = [self.client.project, *table_path]
+        project, dataset_id, table_id = table_path
+        parent = self.write_client.table_path(project, dataset_id, table_id)
+
+        arrow_table = df.to_arrow()
+        row_size = max(1, arrow_table.nbytes // max(1, arrow_table.num_rows))
+        batches = arrow_table.to_batches(
+            max_chunksize=max(1, APPEND_ROWS_MAX_BYTES // row_size)
+        )
+        if not batches:
+            return
+
+        write_stream = self.write_client.create_write_stream(
+            parent=parent,
+            write_stream=types.WriteStream(type_=types.WriteStream.Type.PENDING),
+        )
+
+        def requests():
+            for index, serialized_batch in enumerate(self._serialize_batches(batches)):
+                request = types.AppendRowsRequest(
+                    arrow_rows=types.AppendRowsRequest.ArrowData(
+                        rows=types.ArrowRecordBatch(
+                            serialized_record_batch=serialized_batch
+                        )
+                    )
+                )
+                # Only the first request of the connection carries the stream and schema
+                if index == 0:
+                    request.write_stream = write_stream.name
+                    request.arrow_rows.writer_schema = types.ArrowSchema(
+                        serialized_schema=arrow_table.schema.serialize().to_pybytes()
+                    )
+                yield request
+
+        # The routing header tells the API which region serves the stream, the
+        # client does not add it for streaming calls
+        responses = self.write_client.append_rows(
+            requests(),
+            metadata=(
+                ("x-goog-request-params", f"write_stream={write_stream.name}"),
+            ),
+        )
+        for response in responses:
+            if response.error.code or response.row_errors:
+                raise Exception(
+                    f"Storage Write API append to {path_table_name} failed: "
+                    f"{response.error.message} {list(response.row_errors)}"
+                )
+
+        # An uncommitted pending stream is discarded, so a failure above leaves
+        # the table untouched
+        self.write_client.finalize_write_stream(name=write_stream.name)
+        commit = self.write_client.batch_commit_write_streams(
+            types.BatchCommitWriteStreamsRequest(
+                parent=parent, write_streams=[write_stream.name]
+            )
+        )
+        if commit.stream_errors:
+            raise Exception(
+                f"Storage Write API commit to {path_table_name} failed: "
+                f"{list(commit.stream_errors)}"
+            )
+
+    def load_df_to_table(self, path_table_name: str, df: pl.DataFrame):
+        # Empty frames go through the load job, which still creates a missing table
+        if not df.is_empty() and df.estimated_size() <= STORAGE_WRITE_MAX_BYTES:
+            try:
+                self.append_df_with_write_api(path_table_name, df)
+                return
+            except NotFound:
+                # The write stream needs an existing table; the load job creates it
+                logging.info(
+                    f"{path_table_name} not found, loading it with a load job"
+                )
+            except Exception as error:
+                logging.error(f"Could not load the df to {path_table_name}: {error}")
+                raise error
+
+        # Write DataFrame to stream as parquet file; does not hit disk
+        with io.BytesIO() as stream:
+            df.write_parquet(stream)
+            stream.seek(0)
+            job = self.client.load_table_from_file(
+                stream,
+                destination=path_table_name,
+                project="mi-casino",
+                job_config=bigquery.LoadJobConfig(
+                    source_format=bigquery.SourceFormat.PARQUET,
+                ),
+            )
+        try:
+            job.result()
+        except Exception as error:
+            logging.error(f"Could not load the df to {path_table_name}: {error}")
+            raise error
+
+    def execute_query_to_df_polars(
+        self,
+        sql: str,
+        timeout: int = 30,
+        job_config: bigquery.QueryJobConfig | None = None,
+    ) -> pl.DataFrame | None:
+        try:
+            results = self.execute_query(
+                sql,
+                timeout,
+                job_config,
+            ).to_arrow(bqstorage_client=self.read_client)
+
+            df = pl.from_arrow(results)
+
+            return df
+        except Exception as error:
+            logging.error(
+                f"Failed converting query result to polars dataframe: {sql}\n The error is: {error}",
+                stack_info=True,
+            )
+            raise error
+
+    def get_tables_name_with_regex(
+        self, proyect_id, dataset_id, regex: re.Pattern | str
+    ):
+        """
+        Retrieves the full paths of tables in a BigQuery dataset that start with 'get_'.
+
+        Args:
+            proyecto_id (str): The ID of the Google Cloud project.
+            dataset_id (str): The ID of the BigQuery dataset.
+
+        Returns:
+            list: A list of full paths for tables that start with 'get_'.
+        """
+
+        # Get the dataset reference
+        dataset_ref = self.client.dataset(dataset_id, proyect_id)
+        tables = self.client.list_tables(dataset_ref)
+
+        if isinstance(regex, str):
+            regex = self._compile_regex(regex)
+
+        # Filter tables matching the regex
+        return [table.table_id for table in tables if regex.match(table.table_id)]
+
+    def load_to_gcs_in_parallel(
+        self,
+        tables_name: str,
+        uri_path: str,
+        proyect_id: str,
+        dataset_id: str,
+        max_workers: int = 8,
+    ) -> None:
+        pool = self._get_pool(max_workers)
+        list(
+            pool.map(
+                lambda table_name: self.export_table_to_storage(
+                    proyect_id,
+                    dataset_id,
+                    table_name,
+                    uri_path.format(table_name=table_name),
+                ),
+                tables_name,
+            )
+        )
+
+    def check_and_create_table(
+        self,
+        dataset_id: str,
+        table_id: str,
+        schema: list[bigquery.SchemaField],
+        rows_to_insert: dict | list[dict],
+    ) -> None:
+        table_key = f"{dataset_id}.{table_id}"
+        table_ref = self._table_refs.get(table_key)
+        if table_ref is None:
+            table_ref = self.client.dataset(dataset_id).table(table_id)
+            self._table_refs[table_key] = table_ref
+
+        if table_key not in self._known_tables:
+            try:
+                self.client.get_table(table_ref)
+            except Exception:
+                table = bigquery.Table(table_ref, schema=schema)
+                table = self.client.create_table(table)
+                logging.info(f"The table {table_ref} was created")
+            self._known_tables.add(table_key)
+
+        if not isinstance(rows_to_insert, list):
+            rows_to_insert = [rows_to_insert]
+
+        try:
+            self.client.insert_rows_json(table_ref, rows_to_insert)
+        except Exception as error:
+            logging.error(
+                f"There were errors inserting the data into the table {table_ref}. {error}"
+            )
+            raise error
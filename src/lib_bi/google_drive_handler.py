@@ -1,128 +1,460 @@
-import io
 import os
 import json
 import polars as pl
+import polars.selectors as cs
 import logging
-import gspread
-from datetime import datetime
-from gspread_dataframe import set_with_dataframe
+import threading
+import time
+import tempfile
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from google.oauth2 import service_account
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
+from google.auth.transport.requests import AuthorizedSession
+from googleapiclient.http import MediaFileUpload
 from googleapiclient.discovery import build
 
+# Drive accepts at most 100 calls per batch request
+DRIVE_BATCH_SIZE = 100
+UPLOAD_CHUNKSIZE = 8 * 1024 * 1024
+# Rows written to a sheet per values.update request
+SHEET_WRITE_ROWS = 10_000
+# Seconds a folder listing is reused before asking Drive again
+LIST_CACHE_TTL = 60
+DRIVE_MEDIA_URL = "https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
+DOWNLOAD_CHUNKSIZE = 8 * 1024 * 1024
+
+
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+]
+
+
+def _sheet_range(sheet_name: str, cells: str = "") -> str:
+    """A1 range of a sheet, quoting its name and doubling any quote in it."""
+    quoted_name = "'" + sheet_name.replace("'", "''") + "'"
+    return f"{quoted_name}!{cells}" if cells else quoted_name
+
+
+@lru_cache(maxsize=8)
+def _load_credentials(credentials_env: str) -> tuple:
+    """
+    Parses the service account once per process for each credentials string.
+    The scoped credentials are shared, so their token is fetched once and reused
+    by every handler and thread instead of each one doing its own exchange.
+    """
+    service_account_info = json.loads(credentials_env)
+
+    creds = service_account.Credentials.from_service_account_info(
+        service_account_info
+    )
+
+    return service_account_info, creds, creds.with_scopes(SCOPES)
+
 
 class GoogleDriveHandler:
     def __init__(self, credentials_env: str):
-        self.service_account_info = json.loads(credentials_env)
+        self.service_account_info, self.creds, self.scoped_creds = _load_credentials(
+            credentials_env
+        )
+        self.scopes = SCOPES
+        self._local = threading.local()
+        # Folder listings by (folder id, mime type, excluded names), with fetch time
+        self._listings: dict[tuple[str, str, frozenset], tuple[float, list]] = {}
+        # Schemas inferred for the downloaded csv files, by file id, used as hints
+        self._csv_schemas: dict[str, dict] = {}
 
-        self.creds = service_account.Credentials.from_service_account_info(
-            self.service_account_info
+    def _build_service(self, name: str, version: str):
+        # Each service gets its own HTTP connection, they share the credentials
+        return build(
+            name,
+            version,
+            credentials=self.scoped_creds,
+            cache_discovery=False,
+            static_discovery=True,
+        )
+
+    @property
+    def session(self) -> AuthorizedSession:
+        """Authorized requests session of the calling thread."""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = AuthorizedSession(self.scoped_creds)
+            self._local.session = session
+        return session
+
+    @property
+    def service(self):
+        """Drive v3 service of the calling thread, googleapiclient is not thread-safe."""
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = self._build_service("drive", "v3")
+            self._local.service = service
+        return service
+
+    @property
+    def sheets_service(self):
+        """Sheets v4 service of the calling thread, googleapiclient is not thread-safe."""
+        sheets_service = getattr(self._local, "sheets_service", None)
+        if sheets_service is None:
+            sheets_service = self._build_service("sheets", "v4")
+            self._local.sheets_service = sheets_service
+        return sheets_service
+
+    @staticmethod
+    def _columns_to_df(columns: list) -> pl.DataFrame:
+        # Trailing empty cells are not returned, pad them with empty strings
+        height = max((len(column) for column in columns), default=1)
+        return pl.DataFrame(
+            [
+                pl.Series(
+                    column[0] if column else "",
+                    column[1:] + [""] * (height - max(len(column), 1)),
+                    dtype=pl.String,
+                )
+                for column in columns
+            ]
+        )
+
+    def get_sheet_values(self, spreadsheet_id: str, range_name: str) -> pl.DataFrame:
+        """
+        Reads a range column by column, so the polars columns are built without
+        transposing the rows in Python. The first row is used as header.
+        """
+        columns = (
+            self.sheets_service.spreadsheets()
+            .values()
+            .get(
+                spreadsheetId=spreadsheet_id,
+                range=range_name,
+                majorDimension="COLUMNS",
+            )
+            .execute()
+            .get("values", [])
         )
+        return self._columns_to_df(columns)
 
-        self.service = build("drive", "v3", credentials=self.creds)
-        self.scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive",
+    def get_sheets_values(
+        self, spreadsheet_id: str, range_names: list[str]
+    ) -> list[pl.DataFrame]:
+        """Reads many ranges of the same spreadsheet with a single batchGet request."""
+        value_ranges = (
+            self.sheets_service.spreadsheets()
+            .values()
+            .batchGet(
+                spreadsheetId=spreadsheet_id,
+                ranges=range_names,
+                majorDimension="COLUMNS",
+            )
+            .execute()
+            .get("valueRanges", [])
+        )
+        return [
+            self._columns_to_df(value_range.get("values", []))
+            for value_range in value_ranges
         ]
-        self.gc = gspread.auth.service_account_from_dict(
-            self.service_account_info, self.scopes
+
+    def list_files(
+        self, folder_id: str, mime_type: str, exclude_names: frozenset = frozenset()
+    ) -> list:
+        """
+        Lists every file of a mime type in a folder, following the pagination.
+        Files named in `exclude_names` are filtered out by Drive.
+        Listings are cached for LIST_CACHE_TTL seconds, see `invalidate`.
+        """
+        key = (folder_id, mime_type, exclude_names)
+        cached = self._listings.get(key)
+        if cached is not None and time.monotonic() - cached[0] < LIST_CACHE_TTL:
+            return list(cached[1])
+
+        query = f"'{folder_id}' in parents and mimeType='{mime_type}'"
+        for name in sorted(exclude_names):
+            escaped_name = name.replace("\\", "\\\\").replace("'", "\\'")
+            query += f" and name!='{escaped_name}'"
+
+        request = self.service.files().list(
+            q=query,
+            pageSize=1000,
+            fields="nextPageToken, files(id,name,modifiedTime)",
         )
+        items = []
+        while request is not None:
+            results = request.execute()
+            items.extend(results.get("files", []))
+            request = self.service.files().list_next(request, results)
+
+        self._listings[key] = (time.monotonic(), items)
+        return list(items)
+
+    def invalidate(self, folder_id: str | None = None) -> None:
+        """Drops the cached listings of a folder, or of every folder."""
+        if folder_id is None:
+            self._listings.clear()
+            return
+        for key in [key for key in self._listings if key[0] == folder_id]:
+            del self._listings[key]
 
     def list_csv_files(self, folder_id):
-        query = f"'{folder_id}' in parents and mimeType='text/csv'"
-        results = self.service.files().list(q=query).execute()
-        items = results.get("files", [])
-        return items
+        return self.list_files(folder_id, "text/csv")
 
-    def list_sheet_files(self, folder_id):
-        query = f"'{folder_id}' in parents and mimeType='application/vnd.google-apps.spreadsheet'"
-        results = self.service.files().list(q=query).execute()
-        items = results.get("files", [])
-        return items
-
-    def download_csv_to_df(self, file_id) -> pl.DataFrame:
-        request = self.service.files().get_media(fileId=file_id)
-
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-            print(f"Download {int(status.progress() * 100)}%.")
-
-        fh.seek(0)
-        return pl.read_csv(
-            fh,
-            encoding="utf8-lossy",
-            infer_schema_length=True,
+    def list_sheet_files(self, folder_id, exclude_names: frozenset = frozenset()):
+        return self.list_files(
+            folder_id, "application/vnd.google-apps.spreadsheet", exclude_names
         )
 
+    def download_csv_to_df(
+        self,
+        file_id,
+        schema: dict | None = None,
+        columns: list[str] | None = None,
+        has_header: bool = True,
+    ) -> pl.DataFrame:
+        """
+        Downloads a csv from Drive into a polars DataFrame.
+
+        Args:
+            file_id (str): ID of the Drive file.
+            schema (dict | None, optional): Polars schema of the whole file, skips the type inference.
+                Defaults to inferring it, using a previous download of the same file as hint.
+            columns (list[str] | None, optional): Only parse these columns. Defaults to all.
+            has_header (bool, optional): Whether the first row holds the column names. Defaults to True.
+        """
+        schema_hint = None
+        if schema is None:
+            # Files updated in place keep their id, so the schema of a previous
+            # download is only a hint: new columns are inferred, and a retyped
+            # column makes the file be read again with full inference
+            schema_hint = self._csv_schemas.get(file_id)
+
+        read_options = {
+            "encoding": "utf8-lossy",
+            "columns": columns,
+            "has_header": has_header,
+            "low_memory": True,
+        }
+        with self._download_to_file(file_id) as file:
+            try:
+                # Read from the path, so polars maps the file instead of copying it
+                df = pl.read_csv(
+                    file.name,
+                    schema=schema,
+                    schema_overrides=schema_hint,
+                    infer_schema_length=0 if schema else 1000,
+                    **read_options,
+                )
+            except pl.exceptions.ComputeError as error:
+                if schema_hint is None:
+                    raise error
+                logging.info(f"Schema of the csv {file_id} changed: {error}")
+                df = pl.read_csv(file.name, infer_schema_length=1000, **read_options)
+
+        if columns is None:
+            self._csv_schemas[file_id] = dict(df.schema)
+        return df
+
+    def _download_to_file(self, file_id) -> tempfile.NamedTemporaryFile:
+        # Stream the response to a temporary file on disk in 8MB chunks, a single
+        # GET with alt=media instead of 100KB chunk requests
+        file = tempfile.NamedTemporaryFile(suffix=".csv")
+        try:
+            with self.session.get(
+                DRIVE_MEDIA_URL.format(file_id=file_id), stream=True
+            ) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNKSIZE):
+                    file.write(chunk)
+            file.flush()
+        except BaseException:
+            file.close()
+            raise
+        return file
+
     def extract_sheet(
         self,
         sheet_id: str,
         sheet_name: str,
     ) -> pl.DataFrame:
-        data = self.gc.open_by_key(sheet_id).worksheet(sheet_name).get_all_values()
+        return self.get_sheet_values(sheet_id, _sheet_range(sheet_name))
 
-        df = pl.DataFrame(data[1:], schema=data[0])
+    def extract_sheets(self, sheet_id: str, sheet_names: list[str]) -> dict:
+        """Extracts many sheets of a spreadsheet in one request, keyed by sheet name."""
+        dfs = self.get_sheets_values(
+            sheet_id, [_sheet_range(sheet_name) for sheet_name in sheet_names]
+        )
+        return dict(zip(sheet_names, dfs))
 
-        return df
+    def get_files_metadata(self, file_ids: list, fields: str) -> dict:
+        """
+        Gets the metadata of many files packing up to 100 files().get calls in
+        each batch HTTP request. Returns the metadata keyed by file id.
+        """
+        metadata_by_id = {}
+        errors = []
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors.append(exception)
+                return
+            metadata_by_id[request_id] = response
+
+        for start in range(0, len(file_ids), DRIVE_BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for file_id in file_ids[start : start + DRIVE_BATCH_SIZE]:
+                batch.add(
+                    self.service.files().get(fileId=file_id, fields=fields),
+                    request_id=file_id,
+                )
+            batch.execute()
+
+        if errors:
+            logging.error(f"Could not get the metadata of {len(errors)} files")
+            raise errors[0]
+
+        return metadata_by_id
 
     def extract_all_sheet(
-        self, drive_folder_id: str, filter_sheets: list
+        self, drive_folder_id: str, filter_sheets: list, max_workers: int = 8
     ) -> pl.DataFrame:
-        csv_files = self.list_sheet_files(drive_folder_id)
-        dfs = []
-        for file in csv_files:
-            if file["name"] in filter_sheets:
-                continue
+        filter_sheets = frozenset(filter_sheets)
+        csv_files = [
+            file
+            for file in self.list_sheet_files(drive_folder_id, filter_sheets)
+            if file["name"] not in filter_sheets
+        ]
+        metadata_by_id = self.get_files_metadata(
+            [file["id"] for file in csv_files],
+            "id,lastModifyingUser(displayName),modifiedTime",
+        )
+
+        def fetch_sheet(file: dict) -> pl.DataFrame | None:
             try:
-                data = self.gc.open_by_key(file["id"]).sheet1.get_all_values()
+                # A range without sheet name reads the first sheet
+                return self.get_sheet_values(file["id"], "A:ZZZ")
 
             except Exception as error:
                 print(file["name"])
                 print(error)
-                continue
-            df = pl.DataFrame(data[1:], schema=data[0])
-            last_edited_by = (
-                self.service.files()
-                .get(fileId=file["id"], fields="lastModifyingUser")
-                .execute()["lastModifyingUser"]["displayName"]
-            )
-            last_edited_time = (
-                self.service.files()
-                .get(fileId=file["id"], fields="modifiedTime")
-                .execute()["modifiedTime"]
-            )
+                return None
 
-            last_edited_time = datetime.strptime(
-                last_edited_time, "%Y-%m-%dT%H:%M:%S.%fZ"
-            )
-            df = df.with_columns(
-                pl.lit(last_edited_by).alias("last_edited_by"),
-                pl.lit(last_edited_time).alias("last_edited_time"),
-            )
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            fetched = [
+                (file, df)
+                for file, df in zip(csv_files, pool.map(fetch_sheet, csv_files))
+                if df is not None
+            ]
 
-            dfs.append(df)
         try:
-            df = pl.concat(dfs)
+            df = pl.concat(
+                [df for _, df in fetched], how="vertical_relaxed", rechunk=False
+            )
         except Exception as error:
             logging.error(error)
             raise error
 
-        return df
+        # Build the metadata columns once for all the sheets: one row per sheet
+        # repeated as many times as the sheet has rows, parsed in a single pass
+        metadata = (
+            pl.DataFrame(
+                {
+                    "last_edited_by": [
+                        metadata_by_id[file["id"]]["lastModifyingUser"]["displayName"]
+                        for file, _ in fetched
+                    ],
+                    "last_edited_time": [
+                        metadata_by_id[file["id"]]["modifiedTime"]
+                        for file, _ in fetched
+                    ],
+                    "height": [df.height for _, df in fetched],
+                },
+                schema_overrides={"height": pl.UInt32},
+            )
+            .filter(pl.col("height") > 0)
+            .select(
+                pl.col("last_edited_by", "last_edited_time")
+                .repeat_by("height")
+                .explode()
+            )
+            .with_columns(
+                pl.col("last_edited_time").str.to_datetime(
+                    "%Y-%m-%dT%H:%M:%S%.fZ", time_unit="us"
+                )
+            )
+        )
+
+        return df.hstack(metadata.get_columns())
+
+    def _grow_sheet_grid(
+        self, spreadsheet_id: str, sheet_name: str, row_count: int, column_count: int
+    ) -> None:
+        """
+        Grows the grid of a sheet to at least `row_count` rows and `column_count`
+        columns, writes to cells past the grid are rejected by the values API.
+        """
+        spreadsheet = (
+            self.sheets_service.spreadsheets()
+            .get(
+                spreadsheetId=spreadsheet_id,
+                fields="sheets.properties(sheetId,title,gridProperties)",
+            )
+            .execute()
+        )
+        properties = next(
+            sheet["properties"]
+            for sheet in spreadsheet["sheets"]
+            if sheet["properties"]["title"] == sheet_name
+        )
+        grid = properties.get("gridProperties", {})
+        new_grid = {
+            "rowCount": max(grid.get("rowCount", 0), row_count),
+            "columnCount": max(grid.get("columnCount", 0), column_count),
+        }
+        if new_grid == {key: grid.get(key) for key in new_grid}:
+            return
+
+        self.sheets_service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={
+                "requests": [
+                    {
+                        "updateSheetProperties": {
+                            "properties": {
+                                "sheetId": properties["sheetId"],
+                                "gridProperties": new_grid,
+                            },
+                            "fields": "gridProperties(rowCount,columnCount)",
+                        }
+                    }
+                ]
+            },
+        ).execute()
 
     def upload_df_polars_to_sheet(
         self, df_sheet: pl.DataFrame, sheet_id: str, sheet_name: str
     ) -> None:
+        values_api = self.sheets_service.spreadsheets().values()
         try:
-            sheet = self.gc.open_by_key(sheet_id).worksheet(sheet_name)
+            values_api.clear(
+                spreadsheetId=sheet_id, range=_sheet_range(sheet_name)
+            ).execute()
+            print("Cleaned sheet.")
             try:
-                sheet.clear()
-                print("Cleaned sheet.")
-                # Convert Polars DataFrame to Pandas DataFrame and write to Google Sheet
-                df_sheet_pandas = df_sheet.to_pandas()
-                set_with_dataframe(sheet, df_sheet_pandas)
+                # Dates and decimals are not JSON serializable, NaN is not valid JSON
+                df_sheet = df_sheet.with_columns(
+                    (cs.temporal() | cs.decimal()).cast(pl.String),
+                    cs.float().fill_nan(None),
+                )
+                values = [df_sheet.columns, *df_sheet.rows()]
+                # values.clear does not grow the grid, like set_with_dataframe did
+                self._grow_sheet_grid(
+                    sheet_id, sheet_name, len(values), max(df_sheet.width, 1)
+                )
+                for start in range(0, len(values), SHEET_WRITE_ROWS):
+                    values_api.update(
+                        spreadsheetId=sheet_id,
+                        range=_sheet_range(sheet_name, f"A{start + 1}"),
+                        valueInputOption="USER_ENTERED",
+                        body={"values": values[start : start + SHEET_WRITE_ROWS]},
+                    ).execute()
                 print("DataFrame uploaded to sheet.")
             except Exception as error:
                 print("Could not load DataFrame to sheet.")
@@ -138,19 +470,53 @@ class GoogleDriveHandler:
 
         # Search for existing file
         query = f"name='{file_name}' and '{folder_id}' in parents"
-        results = self.service.files().list(q=query, fields="files(id)").execute()
+        results = (
+            self.service.files()
+            .list(
+                q=query,
+                fields="files(id)",
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
+            )
+            .execute()
+        )
         items = results.get("files", [])
 
-        # Delete existing file if found
+        # Delete existing files if found, all the deletes go in one batch request
         if items:
-            for item in items:
-                self.service.files().delete(fileId=item["id"]).execute()
+            errors = []
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    errors.append(exception)
+                    return
                 print(f"Deleted existing file: {file_name}")
 
-        media = MediaFileUpload(file_path, mimetype="text/csv")
+            for start in range(0, len(items), DRIVE_BATCH_SIZE):
+                batch = self.service.new_batch_http_request(callback=callback)
+                for item in items[start : start + DRIVE_BATCH_SIZE]:
+                    batch.add(
+                        self.service.files().delete(
+                            fileId=item["id"], supportsAllDrives=True
+                        )
+                    )
+                batch.execute()
+
+            if errors:
+                raise errors[0]
+
+        media = MediaFileUpload(
+            file_path, mimetype="text/csv", resumable=True, chunksize=UPLOAD_CHUNKSIZE
+        )
         file = (
             self.service.files()
-            .create(body=file_metadata, media_body=media, fields="id")
+            .create(
+                body=file_metadata,
+                media_body=media,
+                fields="id",
+                supportsAllDrives=True,
+            )
             .execute()
         )
+        self.invalidate(folder_id)
         print(f"File ID: {file.get('id')} uploaded to folder ID: {folder_id}")
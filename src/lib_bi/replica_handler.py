@@ -1,25 +1,92 @@
+import os
 import polars as pl
-import psycopg2
+from psycopg2 import pool
+from urllib.parse import quote, urlencode
 
 
 class ReplicaHandler:
-    def __init__(self, database_name: str, port: int, user: str, host: str):
-        """Initializes the connection to the database."""
+    def __init__(
+        self,
+        database_name: str,
+        port: int,
+        user: str,
+        host: str,
+        password: str | None = None,
+        sslmode: str | None = None,
+        minconn: int = 0,
+        maxconn: int = 10,
+    ):
+        """
+        Initializes the pool of connections to the database.
+
+        ConnectorX does not read the libpq environment, so the password and
+        sslmode default to PGPASSWORD and PGSSLMODE and go in the URI.
+        """
         self.user = user
         self.host = host
         self.port = port
         self.dbname = database_name
+        self.password = password or os.environ.get("PGPASSWORD")
+        self.sslmode = sslmode or os.environ.get("PGSSLMODE")
+
+        credentials = quote(self.user, safe="")
+        if self.password:
+            credentials += ":" + quote(self.password, safe="")
+        self.uri = (
+            f"postgresql://{credentials}@{quote(self.host, safe='')}:{self.port}"
+            f"/{quote(self.dbname, safe='')}"
+        )
+        if self.sslmode:
+            self.uri += "?" + urlencode({"sslmode": self.sslmode})
 
-        self.conn = psycopg2.connect(
+        # Most queries go through ConnectorX, so the pool only opens connections
+        # for the queries with execute_options
+        self.pool = pool.ThreadedConnectionPool(
+            minconn,
+            maxconn,
             host=self.host,
             database=self.dbname,
             user=self.user,
             port=self.port,
+            password=self.password,
+            sslmode=self.sslmode,
         )
 
     def execute_query_to_pl_df(
+        self,
+        sql: str,
+        execute_options: dict | None = None,
+        partition_on: str | None = None,
+        partition_num: int | None = None,
+    ) -> pl.DataFrame:
+        """Executes an SQL query and returns the results as a polars df.
+
+        Reads with ConnectorX straight into Arrow, in `partition_num` parallel
+        connections when `partition_on` is given. Queries with `execute_options`
+        (e.g. bound parameters) use a pooled psycopg2 connection instead.
+        """
+        if execute_options:
+            return self._execute_query_with_pool(sql, execute_options)
+
+        return pl.read_database_uri(
+            sql,
+            self.uri,
+            engine="connectorx",
+            partition_on=partition_on,
+            partition_num=partition_num or (4 if partition_on else None),
+        )
+
+    def _execute_query_with_pool(
         self, sql: str, execute_options: dict | None = None
     ) -> pl.DataFrame:
-        """Executes an SQL query and returns the results as a polars df."""
-        result = pl.read_database(sql, self.conn, execute_options=execute_options)
+        conn = self.pool.getconn()
+        try:
+            result = pl.read_database(sql, conn, execute_options=execute_options)
+        finally:
+            # Dropped connections are discarded so the pool opens a new one
+            self.pool.putconn(conn, close=bool(conn.closed))
         return result
+
+    def close(self) -> None:
+        """Closes all the connections of the pool."""
+        self.pool.closeall()
@@ -1,34 +1,138 @@
 import os
-import pysftp
+import queue
+import paramiko
 import logging
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
 
+SFTP_WINDOW_SIZE = 2**27
+SSH_KEEPALIVE_SECONDS = 30
+
 
 class SftpHandler:
-    def __init__(self, host:str, username:str, password:str):
-        self.conn = pysftp.Connection(host, username, password)
+    def __init__(
+        self,
+        host: str,
+        username: str,
+        password: str,
+        port: int = 22,
+        pool_size: int = 8,
+    ):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.port = port
+        self.pool_size = pool_size
+
+        # A SFTPClient serializes its requests, so every worker takes its own
+        # client, each with its own SSH transport
+        self._pool: queue.Queue[paramiko.SFTPClient] = queue.Queue()
+        # SSH connection of every open SFTP client
+        self._ssh_clients: dict[paramiko.SFTPClient, paramiko.SSHClient] = {}
+        self._lock = threading.Lock()
+
+        # Open the first connection to fail fast on bad credentials
+        self._pool.put(self._open_sftp())
+
+    @classmethod
+    def from_env(cls, **kwargs) -> "SftpHandler":
+        """Builds the handler from the host, user and passwd environment variables."""
+        return cls(
+            host=os.environ["host"],
+            username=os.environ["user"],
+            password=os.environ["passwd"],
+            **kwargs,
+        )
+
+    def _open_sftp(self) -> paramiko.SFTPClient:
+        ssh = paramiko.SSHClient()
+        ssh.load_system_host_keys()
+        ssh.set_missing_host_key_policy(paramiko.RejectPolicy())
+        ssh.connect(
+            self.host,
+            port=self.port,
+            username=self.username,
+            password=self.password,
+            look_for_keys=False,
+            allow_agent=False,
+        )
+        transport = ssh.get_transport()
+        # Keepalives stop idle connections from being dropped between uploads
+        transport.set_keepalive(SSH_KEEPALIVE_SECONDS)
+        # A large window keeps more pipelined writes in flight on high latency links
+        sftp = paramiko.SFTPClient.from_transport(
+            transport, window_size=SFTP_WINDOW_SIZE
+        )
+        with self._lock:
+            self._ssh_clients[sftp] = ssh
+        return sftp
+
+    def _discard_sftp(self, sftp: paramiko.SFTPClient) -> None:
+        with self._lock:
+            ssh = self._ssh_clients.pop(sftp, None)
+        if ssh is not None:
+            ssh.close()
+
+    def _get_sftp(self) -> paramiko.SFTPClient:
+        while True:
+            try:
+                sftp = self._pool.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_open = len(self._ssh_clients) < self.pool_size
+                if can_open:
+                    return self._open_sftp()
+                sftp = self._pool.get()
+
+            if sftp.get_channel().get_transport().is_active():
+                return sftp
+            # The server dropped the connection, replace it
+            self._discard_sftp(sftp)
+
+    def close(self) -> None:
+        with self._lock:
+            for ssh in self._ssh_clients.values():
+                ssh.close()
+            self._ssh_clients.clear()
+        self._pool = queue.Queue()
+
+    def __enter__(self) -> "SftpHandler":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def _upload_file(self, local_file_path: str, filename: str) -> None:
+        sftp = self._get_sftp()
+        try:
+            # Upload the file
+            with open(local_file_path, "rb") as file:
+                sftp.putfo(file, filename, file_size=os.path.getsize(local_file_path))
+            logging.info(f"Uploaded: {filename}")
+        except Exception as error:
+            logging.info(f"Couldnt upload: {filename}")
+            raise error
+        finally:
+            self._pool.put(sftp)
 
     def upload_files(self, output_folder: str, filename: str) -> None:
         local_file_path = os.path.join(output_folder, filename)
 
         # Check if it's a file (not a directory)
         if os.path.isfile(local_file_path):
-            try:
-                # Upload the file
-                self.conn.put(local_file_path)
-                logging.info(f"Uploaded: {filename}")
-            except Exception as error:
-                logging.info(f"Couldnt upload: {filename}")
-                raise error
+            self._upload_file(local_file_path, filename)
 
     def upload_all_files_in_parallel(self, output_folder: str):
         start = time.time()
-        files_name_to_upload = os.listdir(output_folder)
-        with ThreadPoolExecutor() as pool:
-            pool.map(
-                lambda item: self.upload_files(output_folder, item),
-                files_name_to_upload,
+        # One thread per pooled connection, more threads would only queue for a
+        # client or trip the server's MaxStartups limit
+        with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+            list(
+                pool.map(
+                    lambda entry: self._upload_file(entry.path, entry.name),
+                    (entry for entry in os.scandir(output_folder) if entry.is_file()),
+                )
             )
 
         logging.info("All files loaded successfully :3")